@@ -1,14 +1,20 @@
 import streamlit as st
 import requests
 import pandas as pd
+import numpy as np
 import datetime
 import altair as alt
 import json
 import os
 import openai
 import base64
+import hashlib
+import tempfile
+import threading
+import time
 from io import BytesIO
-from github import Github
+from filelock import FileLock
+from github import Github, GithubException, UnknownObjectException
 
 # 🔐 Protection par mot de passe simple
 def check_password():
@@ -41,6 +47,30 @@ PLAN_PATH = "plan_semi_vincennes_2025.json"
 CACHE_PARQUET_PATH = "data/strava_data_cache.parquet"
 PLAN_YEAR = 2025
 
+# Grade Adjusted Pace : lissage de l'altitude puis pente calculée sur ±GAP_DEMI_FENETRE points
+GAP_FENETRE_LISSAGE = 15
+GAP_DEMI_FENETRE = 5
+GAP_PENTE_MAX = 0.45
+# Coût énergétique de la course en fonction de la pente (Minetti et al., 2002), en J/kg/m
+GAP_COUT_COEFFS = [155.4, -30.4, -43.3, 46.3, 19.5, 3.6]
+# Types d'activité auxquels le modèle de course à pied (GAP, meilleurs efforts) s'applique
+TYPES_COURSE = {"Run", "TrailRun", "VirtualRun"}
+
+# Courbes "meilleurs efforts" (mean-maximal) : enveloppe cumulée sur tout l'historique
+MMP_ENVELOPPE_PATH = "data/strava_mmp_envelope.json"
+MMP_DUREES_S = [10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 300, 420, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200]
+MMP_TYPES = TYPES_COURSE
+# Au-delà, un écart entre deux points est considéré comme une pause
+MMP_PAUSE_MAX_S = 10
+
+# Nombre de specs de graphiques gardées en mémoire (éviction LRU)
+GRAPHIQUES_CACHE_MAX = 64
+
+# Écritures concurrentes : verrou fichier local puis commit GitHub optimiste
+VERROU_TIMEOUT_S = 60
+GITHUB_COMMIT_TENTATIVES = 5
+GITHUB_STATUTS_CONFLIT = (409, 422)
+
 
 def minutes_to_mmss(minutes: float) -> str:
     """Convert minutes per km to mm:ss string."""
@@ -58,10 +88,359 @@ def seconds_to_mmss(seconds: float) -> str:
     total_seconds = int(round(seconds))
     m, s = divmod(total_seconds, 60)
     return f"{m:02d}:{s:02d}"
+
+
+def seconds_to_hmmss(seconds: float) -> str:
+    """Convert a duration in seconds to h:mm:ss string."""
+    if seconds is None or pd.isna(seconds):
+        return ""
+    m, s = divmod(int(round(seconds)), 60)
+    h, m = divmod(m, 60)
+    return f"{h:d}:{m:02d}:{s:02d}"
+
+
+def verrou_fichier(path):
+    """Inter-process lock guarding read-modify-write cycles on `path`."""
+    return FileLock(f"{path}.lock", timeout=VERROU_TIMEOUT_S)
+
+
+def ecrire_fichier_atomique(path, data: bytes):
+    """Write `data` to a temp file in the same directory, then rename it over `path`."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+    # mkstemp crée le fichier en 0600 : on garde le mode du fichier remplacé
+    mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644
+    try:
+        with os.fdopen(fd, "wb") as f:
+            os.chmod(tmp_path, mode)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def pace_seconds_to_mmss(seconds) -> pd.Series:
+    """Vectorised version of seconds_to_mmss for a whole pace series."""
+    total = pd.Series(seconds, dtype="float64").round()
+    m = (total // 60).astype("Int64").astype(str).str.zfill(2)
+    s = (total % 60).astype("Int64").astype(str).str.zfill(2)
+    return (m + ":" + s).where(total.notna(), "")
+
+
+def calculer_facteur_gap(distance_stream, altitude_stream):
+    """
+    Facteur GAP par point : pente lissée puis ratio du coût énergétique
+    par rapport au plat. Tout est calculé sur les tableaux complets.
+    """
+    distance = np.asarray(distance_stream, dtype="float64")
+    altitude = np.asarray(altitude_stream, dtype="float64")
+    n = len(distance)
+    if n == 0 or len(altitude) != n:
+        return np.ones(n, dtype="float64")
+
+    fenetre = min(GAP_FENETRE_LISSAGE, n)
+    noyau = np.ones(fenetre) / fenetre
+    padded = np.pad(altitude, (fenetre // 2, fenetre - 1 - fenetre // 2), mode="edge")
+    altitude_lissee = np.convolve(padded, noyau, mode="valid")
+
+    idx = np.arange(n)
+    bas = np.clip(idx - GAP_DEMI_FENETRE, 0, n - 1)
+    haut = np.clip(idx + GAP_DEMI_FENETRE, 0, n - 1)
+    delta_d = distance[haut] - distance[bas]
+    delta_a = altitude_lissee[haut] - altitude_lissee[bas]
+    pente = np.divide(delta_a, delta_d, out=np.zeros(n), where=delta_d > 1.0)
+    pente = np.clip(pente, -GAP_PENTE_MAX, GAP_PENTE_MAX)
+
+    return np.polyval(GAP_COUT_COEFFS, pente) / GAP_COUT_COEFFS[-1]
+
+
+def calculer_streams_gap(distance_stream, altitude_stream, velocity_stream):
+    """
+    Renvoie (vitesse GAP en m/s, distance équivalente à plat en km).
+    La vitesse GAP est stockée en float32 comme les autres streams compacts.
+    """
+    distance = np.asarray(distance_stream, dtype="float64")
+    velocity = np.asarray(velocity_stream, dtype="float64")
+    if len(distance) == 0 or len(altitude_stream) != len(distance):
+        return np.array([], dtype="float32"), None
+
+    facteur = calculer_facteur_gap(distance, altitude_stream)
+    delta_d = np.diff(distance, prepend=distance[0])
+    distance_gap_km = float(np.sum(facteur * np.maximum(delta_d, 0.0)) / 1000)
+
+    if len(velocity) != len(distance):
+        return np.array([], dtype="float32"), distance_gap_km
+    return (velocity * facteur).astype("float32"), distance_gap_km
+
+
+def stream_en_tableau(stream):
+    """Return a stream as a float array (empty when missing or NaN in the cache)."""
+    if stream is None or isinstance(stream, float):
+        return np.array([], dtype="float64")
+    return np.asarray(stream, dtype="float64")
+
+
+def calculer_courbe_mmp(temps_stream, valeurs_stream):
+    """
+    Meilleure moyenne de `valeurs_stream` sur chaque durée de MMP_DUREES_S,
+    via une somme cumulée rééchantillonnée à 1 s (NaN si l'activité est trop courte).
+    """
+    temps = stream_en_tableau(temps_stream)
+    valeurs = stream_en_tableau(valeurs_stream)
+    courbe = np.full(len(MMP_DUREES_S), np.nan)
+    if len(temps) < 2 or len(valeurs) != len(temps):
+        return courbe
+
+    dt = np.clip(np.diff(temps), 0, MMP_PAUSE_MAX_S)
+    temps_mouvement = np.concatenate([[0.0], np.cumsum(dt)])
+    cumul = np.concatenate([[0.0], np.cumsum(valeurs[1:] * dt)])
+    cumul_1s = np.interp(np.arange(int(temps_mouvement[-1]) + 1), temps_mouvement, cumul)
+
+    for k, duree in enumerate(MMP_DUREES_S):
+        if duree >= len(cumul_1s):
+            break
+        courbe[k] = np.max(cumul_1s[duree:] - cumul_1s[:-duree]) / duree
+    return courbe
+
+
+def enveloppe_mmp_initialisee():
+    """Whether a stored envelope exists for the current duration grid."""
+    try:
+        with open(MMP_ENVELOPPE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f).get("durees") == MMP_DUREES_S
+    except Exception:
+        return False
+
+
+def charger_enveloppe_mmp():
+    """Load the mean-maximal envelope stored next to the Parquet cache."""
+    vide = {
+        "durees": MMP_DUREES_S,
+        "activites": [],
+        "vitesse": [None] * len(MMP_DUREES_S),
+        "vitesse_id": [None] * len(MMP_DUREES_S),
+        "fc": [None] * len(MMP_DUREES_S),
+        "fc_id": [None] * len(MMP_DUREES_S),
+    }
+    if os.path.exists(MMP_ENVELOPPE_PATH):
+        try:
+            with open(MMP_ENVELOPPE_PATH, "r", encoding="utf-8") as f:
+                enveloppe = json.load(f)
+            # Grille de durées modifiée : on repart de zéro
+            if enveloppe.get("durees") == MMP_DUREES_S:
+                return enveloppe
+        except Exception:
+            pass
+    return vide
+
+
+def mettre_a_jour_enveloppe_mmp(df_acts):
+    """
+    Fusionne dans l'enveloppe les courbes des activités qui n'y sont pas encore.
+    Chaque activité n'est traitée qu'une seule fois : l'historique n'est jamais rescanné.
+    """
+    if df_acts is None or df_acts.empty or "id" not in df_acts.columns:
+        return charger_enveloppe_mmp()
+    with verrou_fichier(MMP_ENVELOPPE_PATH):
+        return _fusionner_enveloppe_mmp(charger_enveloppe_mmp(), df_acts)
+
+
+def _fusionner_enveloppe_mmp(enveloppe, df_acts):
+    """Merge unseen activities into `enveloppe` and persist it (caller holds the lock)."""
+    deja_traitees = set(enveloppe["activites"])
+    nouvelles = df_acts[~df_acts["id"].astype(str).isin(deja_traitees)]
+    if nouvelles.empty:
+        return enveloppe
+
+    for _, row in nouvelles.iterrows():
+        act_id = str(row["id"])
+        deja_traitees.add(act_id)
+        if row.get("Type") not in MMP_TYPES:
+            continue
+        # Une course sans streams (429, erreur) reste marquée traitée : ses courbes sont vides
+        for cle, colonne in (("vitesse", "Vitesse Stream"), ("fc", "FC Stream")):
+            courbe = calculer_courbe_mmp(row.get("Temps Stream"), row.get(colonne))
+            meilleur = np.array(enveloppe[cle], dtype="float64")
+            ameliore = courbe > np.nan_to_num(meilleur, nan=-np.inf)
+            for k in np.flatnonzero(ameliore):
+                enveloppe[cle][k] = float(courbe[k])
+                enveloppe[f"{cle}_id"][k] = act_id
+
+    enveloppe["activites"] = sorted(deja_traitees)
+    ecrire_fichier_atomique(MMP_ENVELOPPE_PATH, json.dumps(enveloppe, ensure_ascii=False).encode("utf-8"))
+    return enveloppe
+
+
+def fusionner_enveloppes(enveloppe, autre):
+    """Per-duration maximum of two envelopes; `autre` is ignored if its duration grid differs."""
+    fusion = json.loads(json.dumps(enveloppe))
+    if autre.get("durees") != fusion["durees"]:
+        return fusion
+    for cle in ("vitesse", "fc"):
+        for k, valeur in enumerate(autre[cle]):
+            if valeur is not None and (fusion[cle][k] is None or valeur > fusion[cle][k]):
+                fusion[cle][k] = valeur
+                fusion[f"{cle}_id"][k] = autre[f"{cle}_id"][k]
+    fusion["activites"] = sorted(set(fusion["activites"]) | set(autre["activites"]))
+    return fusion
+
+
+def version_donnees_cache():
+    """Data version used to invalidate memoised charts: mtime of the Parquet cache."""
+    if os.path.exists(CACHE_PARQUET_PATH):
+        return os.stat(CACHE_PARQUET_PATH).st_mtime_ns
+    return 0
+
+
+def empreinte_activites(df):
+    """Fingerprint of a charted activity frame: row count and sorted ids."""
+    ids = sorted(df["id"].astype(str)) if "id" in df.columns else []
+    return f"{len(df)}:{hashlib.sha1(','.join(ids).encode('utf-8')).hexdigest()}"
+
+
+@st.cache_data(max_entries=GRAPHIQUES_CACHE_MAX, show_spinner=False)
+def spec_graphique(act_id, type_graphique, version, _construire):
+    """
+    Spec Vega-Lite sérialisée d'un graphique, mémoïsée par (activité, type de
+    graphique, version des données). `_construire` n'est appelé qu'en cas de miss.
+    Les streams Strava dépassent souvent 5000 points : pas de limite de lignes,
+    comme avec le transformer de st.altair_chart.
+    """
+    with alt.data_transformers.disable_max_rows():
+        return _construire().to_dict()
+
+
+def graphique_fc(distance_stream, fc_stream, titre):
+    """HR along the activity distance."""
+    df_hr = pd.DataFrame({
+        "Distance (km)": stream_en_tableau(distance_stream) / 1000,
+        "Fréquence cardiaque (bpm)": stream_en_tableau(fc_stream),
+    })
+    return (
+        alt.Chart(df_hr)
+        .mark_line(color="crimson")
+        .encode(
+            x=alt.X("Distance (km)", title="Distance (km)", scale=alt.Scale(zero=False)),
+            y=alt.Y("Fréquence cardiaque (bpm)", title="FC (bpm)", scale=alt.Scale(zero=False)),
+            tooltip=["Distance (km)", "Fréquence cardiaque (bpm)"]
+        )
+        .interactive()
+        .properties(width=700, height=300, title=titre)
+    )
+
+
+def graphique_allure(distance_stream, velocity_stream):
+    """Pace along the activity distance (raw or GAP velocity stream)."""
+    velocity = stream_en_tableau(velocity_stream)
+    pace_seconds = np.divide(
+        1000.0, velocity, out=np.full(len(velocity), np.nan), where=velocity > 0
+    )
+    df_pace = pd.DataFrame({
+        "Distance (km)": stream_en_tableau(distance_stream) / 1000,
+        "Allure (s/km)": pace_seconds,
+        "Allure (mm:ss/km)": pace_seconds_to_mmss(pace_seconds).to_numpy(),
+    })
+    return (
+        alt.Chart(df_pace)
+        .mark_line(color="steelblue")
+        .encode(
+            x=alt.X("Distance (km)", title="Distance (km)", scale=alt.Scale(zero=False)),
+            y=alt.Y(
+                "Allure (s/km)",
+                type="quantitative",
+                title="Allure (mm:ss/km)",
+                scale=alt.Scale(zero=False, reverse=True),
+                axis=alt.Axis(labelExpr="timeFormat(datum.value*1000, '%M:%S')"),
+            ),
+            tooltip=[
+                alt.Tooltip("Distance (km):Q", title="Distance (km)"),
+                alt.Tooltip(field="Allure (mm:ss/km)", type="nominal", title="Allure (mm:ss/km)"),
+            ]
+        )
+        .interactive()
+        .properties(width=700, height=300, title="Évolution de l'allure")
+    )
+
+
+def graphique_hebdo(df, allure_gap):
+    """Weekly volume bars layered with the weekly average pace (optionally GAP)."""
+    df_week_src = df.copy()
+    if "Distance GAP (km)" not in df_week_src.columns:
+        df_week_src["Distance GAP (km)"] = None
+    # Les activités sans altitude gardent leur distance réelle
+    df_week_src["Distance GAP (km)"] = (
+        pd.to_numeric(df_week_src["Distance GAP (km)"], errors="coerce")
+        .fillna(df_week_src["Distance (km)"])
+    )
+    df_weekly = df_week_src.groupby("Semaine").agg({
+        "Distance (km)": "sum",
+        "Distance GAP (km)": "sum",
+        "Durée (min)": "sum"
+    }).reset_index()
+    distance_allure = "Distance GAP (km)" if allure_gap else "Distance (km)"
+    df_weekly["Allure (min/km)"] = df_weekly["Durée (min)"] / df_weekly[distance_allure]
+    df_weekly["Allure (s/km)"] = df_weekly["Allure (min/km)"] * 60
+    df_weekly["Allure (mm:ss/km)"] = df_weekly["Allure (min/km)"].apply(minutes_to_mmss)
+
+    bar_chart = (
+        alt.Chart(df_weekly)
+        .mark_bar(color="#1f77b4")
+        .encode(
+            x=alt.X("Semaine:O", title="Semaine"),
+            y=alt.Y("Distance (km):Q", title="Distance (km)"),
+            tooltip=[
+                alt.Tooltip("Semaine:N", title="Semaine"),
+                alt.Tooltip("Distance (km):Q", title="Distance (km)"),
+                alt.Tooltip(field="Allure (mm:ss/km)", type="nominal", title="Allure (mm:ss/km)"),
+            ],
+        )
+    )
+
+    line_chart = (
+        alt.Chart(df_weekly)
+        .mark_line(color="orange", point=True)
+        .encode(
+            x="Semaine:O",
+            y=alt.Y(
+                "Allure (s/km)",
+                type="quantitative",
+                title="Allure (mm:ss/km)",
+                axis=alt.Axis(
+                    titleColor="orange",
+                    labelExpr="timeFormat(datum.value*1000, '%M:%S')",
+                ),
+                scale=alt.Scale(reverse=True),
+            ),
+            tooltip=[
+                alt.Tooltip(
+                    field="Allure (mm:ss/km)",
+                    type="nominal",
+                    title="Allure (mm:ss/km)",
+                )
+            ],
+        )
+    )
+
+    return alt.layer(bar_chart, line_chart).resolve_scale(y='independent').properties(
+        width=700, height=400
+    )
+
 
-if os.path.exists(PLAN_PATH):
-    with open(PLAN_PATH, "r", encoding="utf-8") as f:
-        plan_data = json.load(f)
+def plan_vers_dataframe(plan_data):
+    """
+    Plan JSON -> une ligne par séance. Accepte le format d'origine {"weeks": [...]}
+    comme la liste de séances écrite après une modification IA.
+    """
+    if isinstance(plan_data, list):
+        df_plan = pd.DataFrame(plan_data)
+        if "date" in df_plan.columns:
+            df_plan["date"] = pd.to_datetime(df_plan["date"], errors="coerce").dt.date
+            df_plan.sort_values(by="date", inplace=True)
+        return df_plan
+
     weeks = plan_data.get("weeks", [])
     day_map = {day: i for i, day in enumerate(["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"])}
     records = []
@@ -91,66 +470,145 @@ if os.path.exists(PLAN_PATH):
     df_plan = pd.DataFrame(records)
     if not df_plan.empty:
         df_plan.sort_values(by="date", inplace=True)
+    return df_plan
+
+
+if os.path.exists(PLAN_PATH):
+    with open(PLAN_PATH, "r", encoding="utf-8") as f:
+        plan_data = json.load(f)
+    df_plan = plan_vers_dataframe(plan_data)
 else:
     df_plan = pd.DataFrame()
 
+def lire_parquet_octets(data):
+    """Read Parquet bytes, handling base64 encoded content (when pulled from GitHub)."""
+    try:
+        return pd.read_parquet(BytesIO(data))
+    except Exception:
+        return pd.read_parquet(BytesIO(base64.b64decode(data)))
+
+
+def parquet_octets(df):
+    buffer = BytesIO()
+    df.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def fusionner_activites(df_base, df_ajout):
+    """Append to `df_base` the activities of `df_ajout` whose id it does not have yet."""
+    if df_base.empty or "id" not in df_base.columns:
+        return df_ajout.copy()
+    if df_ajout.empty or "id" not in df_ajout.columns:
+        return df_base.copy()
+    ids_existants = set(df_base["id"].astype(str))
+    df_nouvelles = df_ajout[~df_ajout["id"].astype(str).isin(ids_existants)]
+    return pd.concat([df_base, df_nouvelles], ignore_index=True)
+
+
 # Corriger le chargement de fichier parquet vide ou non valide
 def charger_cache_parquet():
     """Load the local Parquet cache, handling base64 encoded content."""
     if os.path.exists(CACHE_PARQUET_PATH) and os.path.getsize(CACHE_PARQUET_PATH) > 0:
         try:
-            try:
-                # First attempt: direct parquet read
-                return pd.read_parquet(CACHE_PARQUET_PATH)
-            except Exception:
-                # File may be base64 encoded (when pulled from GitHub)
-                with open(CACHE_PARQUET_PATH, "rb") as f:
-                    data = base64.b64decode(f.read())
-                return pd.read_parquet(BytesIO(data))
+            with open(CACHE_PARQUET_PATH, "rb") as f:
+                return lire_parquet_octets(f.read())
         except Exception:
             st.warning("⚠️ Cache invalide. Il sera régénéré.")
     return pd.DataFrame()
 
+
+def contenu_fichier_github(repo, fichier):
+    """
+    Bytes of a file from get_contents. Above 1 MB the contents API returns no
+    content (encoding "none"), so the blob is fetched through the git data API.
+    """
+    if fichier.encoding == "base64":
+        return fichier.decoded_content
+    return base64.b64decode(repo.get_git_blob(fichier.sha).content)
+
+
+def commit_fichier_github(path, construire_contenu, message, message_creation=None):
+    """
+    Commit avec concurrence optimiste : `construire_contenu(contenu_distant)` est
+    appelé sur la dernière version distante (None si absente), puis le commit est
+    fait avec le sha lu. Si un autre commit est passé entre-temps, on relit et on recommence.
+    Renvoie le contenu effectivement commité.
+    """
+    repo = Github(github_token).get_repo(github_repo)
+    for tentative in range(GITHUB_COMMIT_TENTATIVES):
+        try:
+            fichier = repo.get_contents(path)
+        except UnknownObjectException:
+            fichier = None
+
+        contenu = construire_contenu(contenu_fichier_github(repo, fichier) if fichier is not None else None)
+        try:
+            if fichier is None:
+                repo.create_file(path=path, message=message_creation or message, content=contenu)
+            else:
+                repo.update_file(path=path, message=message, content=contenu, sha=fichier.sha)
+            return contenu
+        except GithubException as e:
+            if e.status not in GITHUB_STATUTS_CONFLIT or tentative == GITHUB_COMMIT_TENTATIVES - 1:
+                raise
+            time.sleep(0.5 * 2 ** tentative)
+
+
 # Ne pas redéfinir deux fois cette fonction dans le fichier !
 def mettre_a_jour_et_commit_cache_parquet(new_activities_df):
-    if os.path.exists(CACHE_PARQUET_PATH):
-        try:
-            df_cache = pd.read_parquet(CACHE_PARQUET_PATH)
-            ids_existants = set(df_cache["id"].astype(str))
-            df_nouvelles = new_activities_df[~new_activities_df["id"].astype(str).isin(ids_existants)]
-            df_final = pd.concat([df_cache, df_nouvelles], ignore_index=True)
-        except:
-            df_final = new_activities_df
-    else:
-        df_final = new_activities_df
-
-    df_final.to_parquet(CACHE_PARQUET_PATH, index=False)
-
-    buffer = BytesIO()
-    df_final.to_parquet(buffer, index=False)
-    buffer.seek(0)
-    content_encoded = base64.b64encode(buffer.read()).decode('utf-8')
-
-    g = Github(github_token)
-    repo = g.get_repo(github_repo)
-    path_remote = CACHE_PARQUET_PATH
-
-    try:
-        file = repo.get_contents(path_remote)
-        repo.update_file(
-            path=path_remote,
-            message="🔄 Mise à jour du cache Strava (parquet)",
-            content=content_encoded,
-            sha=file.sha
-        )
-    except:
-        repo.create_file(
-            path=path_remote,
-            message="✨ Création initiale du cache Strava (parquet)",
-            content=content_encoded
-        )
+    """Merge, write and commit the cache; return the full merged cache."""
+    with verrou_fichier(CACHE_PARQUET_PATH):
+        df_final = fusionner_activites(charger_cache_parquet(), new_activities_df)
+        ecrire_fichier_atomique(CACHE_PARQUET_PATH, parquet_octets(df_final))
 
+    def contenu_fusionne(contenu_distant):
+        nonlocal df_final
+        # Un cache distant illisible lève une erreur plutôt que d'être écrasé
+        if contenu_distant:
+            df_final = fusionner_activites(df_final, lire_parquet_octets(contenu_distant))
+        return base64.b64encode(parquet_octets(df_final)).decode('utf-8')
+
+    commit_fichier_github(
+        CACHE_PARQUET_PATH,
+        contenu_fusionne,
+        message="🔄 Mise à jour du cache Strava (parquet)",
+        message_creation="✨ Création initiale du cache Strava (parquet)",
+    )
 
+    # Le cache distant a pu apporter des activités synchronisées par une autre session
+    with verrou_fichier(CACHE_PARQUET_PATH):
+        df_local = charger_cache_parquet()
+        df_complet = fusionner_activites(df_local, df_final)
+        if len(df_complet) > len(df_local):
+            ecrire_fichier_atomique(CACHE_PARQUET_PATH, parquet_octets(df_complet))
+    return df_complet
+
+
+def commit_enveloppe_mmp(enveloppe):
+    """
+    Commit l'enveloppe à côté du cache pour qu'elle survive aux redémarrages.
+    Deux enveloppes se fusionnent sans conflit (maximum par durée, union des ids).
+    """
+    def contenu_fusionne(contenu_distant):
+        nonlocal enveloppe
+        if contenu_distant:
+            enveloppe = fusionner_enveloppes(enveloppe, json.loads(contenu_distant))
+        return json.dumps(enveloppe, ensure_ascii=False)
+
+    commit_fichier_github(
+        MMP_ENVELOPPE_PATH,
+        contenu_fusionne,
+        message="🏆 Mise à jour des meilleurs efforts",
+        message_creation="✨ Création initiale des meilleurs efforts",
+    )
+
+    # L'enveloppe distante a pu apporter des activités traitées par une autre session
+    with verrou_fichier(MMP_ENVELOPPE_PATH):
+        enveloppe = fusionner_enveloppes(charger_enveloppe_mmp(), enveloppe)
+        ecrire_fichier_atomique(MMP_ENVELOPPE_PATH, json.dumps(enveloppe, ensure_ascii=False).encode("utf-8"))
+    return enveloppe
+
+
 def refresh_access_token():
     url = "https://www.strava.com/oauth/token"
     payload = {
@@ -235,7 +693,7 @@ def construire_dataframe_activites_complet(activities, access_token):
 
         # Appel de l'API Strava pour récupérer les streams utiles
         stream_url = f"https://www.strava.com/api/v3/activities/{act['id']}/streams"
-        params = {"keys": "heartrate,time,distance,velocity_smooth", "key_by_type": "true"}
+        params = {"keys": "heartrate,time,distance,velocity_smooth,altitude,latlng", "key_by_type": "true"}
         try:
             stream_res = requests.get(stream_url, headers=headers, params=params)
             if stream_res.status_code == 200:
@@ -244,16 +702,40 @@ def construire_dataframe_activites_complet(activities, access_token):
                 row["Temps Stream"] = stream_data.get("time", {}).get("data", [])
                 row["Distance Stream"] = stream_data.get("distance", {}).get("data", [])
                 row["Vitesse Stream"] = stream_data.get("velocity_smooth", {}).get("data", [])
+                # Forme compacte : float32, latlng aplati en [lat0, lng0, lat1, lng1, ...]
+                row["Altitude Stream"] = np.asarray(
+                    stream_data.get("altitude", {}).get("data", []), dtype="float32"
+                )
+                row["LatLng Stream"] = np.asarray(
+                    stream_data.get("latlng", {}).get("data", []), dtype="float32"
+                ).ravel()
             else:
                 row["FC Stream"] = []
                 row["Temps Stream"] = []
                 row["Distance Stream"] = []
                 row["Vitesse Stream"] = []
+                row["Altitude Stream"] = np.array([], dtype="float32")
+                row["LatLng Stream"] = np.array([], dtype="float32")
         except Exception as e:
             row["FC Stream"] = []
             row["Temps Stream"] = []
             row["Distance Stream"] = []
             row["Vitesse Stream"] = []
+            row["Altitude Stream"] = np.array([], dtype="float32")
+            row["LatLng Stream"] = np.array([], dtype="float32")
+
+        # Allure ajustée à la pente (GAP), calculée une seule fois à l'ingestion (courses uniquement)
+        if row["Type"] in TYPES_COURSE:
+            vitesse_gap, distance_gap_km = calculer_streams_gap(
+                row["Distance Stream"], row["Altitude Stream"], row["Vitesse Stream"]
+            )
+        else:
+            vitesse_gap, distance_gap_km = np.array([], dtype="float32"), None
+        row["Vitesse GAP Stream"] = vitesse_gap
+        row["Distance GAP (km)"] = round(distance_gap_km, 2) if distance_gap_km else None
+        row["Allure GAP (min/km)"] = (
+            (act.get("elapsed_time", 0) / 60) / distance_gap_km if distance_gap_km else None
+        )
 
         rows.append(row)
 
@@ -265,17 +747,30 @@ def construire_dataframe_activites_complet(activities, access_token):
         df["Allure (s/km)"] = df["Allure (min/km)"] * 60
     return df
 
-def commit_to_github(updated_text):
-    g = Github(github_token)
-    repo = g.get_repo(github_repo)
-    file = repo.get_contents(PLAN_PATH)
-    old_sha = file.sha
-    repo.update_file(
-        path=PLAN_PATH,
-        message="Mise a jour automatique du plan via IA",
-        content=updated_text,
-        sha=old_sha
-    )
+def appliquer_modification_plan(df_plan_base, new_obj):
+    """Replace (or add) the session dated like `new_obj` and return the plan as JSON text."""
+    df_modif = df_plan_base.copy()
+    df_modif["date"] = pd.to_datetime(df_modif["date"])
+    df_modif.set_index("date", inplace=True)
+    new_date = pd.to_datetime(new_obj["date"])
+    df_modif.loc[new_date] = new_obj
+    df_modif.reset_index(inplace=True)
+    df_modif.sort_values(by="date", inplace=True)
+    return json.dumps(df_modif.to_dict(orient="records"), indent=2, ensure_ascii=False, default=str)
+
+
+def commit_to_github(updated_text, fusionner=None):
+    """
+    `fusionner(texte_distant)` ré-applique la modification sur la version distante
+    à chaque tentative ; sans lui, `updated_text` est commité tel quel. Un échec de
+    fusion est propagé pour ne jamais écraser une modification concurrente.
+    """
+    def contenu(contenu_distant):
+        if fusionner is None or contenu_distant is None:
+            return updated_text
+        return fusionner(contenu_distant.decode("utf-8"))
+
+    return commit_fichier_github(PLAN_PATH, contenu, message="Mise a jour automatique du plan via IA")
 def appel_chatgpt_conseil(question, df_activities, df_plan):
 
     # Préparer le contexte des données
@@ -322,12 +817,35 @@ def get_activities_cached():
 
     if new_acts:
         df_new = construire_dataframe_activites_complet(new_acts, access_token)
-        mettre_a_jour_et_commit_cache_parquet(df_new)
-        df_cache = pd.concat([df_cache, df_new], ignore_index=True)
+        # Inclut les activités synchronisées par d'autres sessions et récupérées du distant
+        df_cache = mettre_a_jour_et_commit_cache_parquet(df_new)
+        commit_enveloppe_mmp(mettre_a_jour_enveloppe_mmp(df_new))
 
     if "id" in df_cache.columns:
         df_cache.drop_duplicates(subset="id", inplace=True)
     return df_cache
+
+
+@st.cache_resource
+def verrou_synchronisation():
+    """Process-wide lock shared by all browser sessions."""
+    return threading.Lock()
+
+
+def synchroniser_activites():
+    """
+    Rafraîchit les activités Strava. Si une autre session synchronise déjà,
+    on attend sa fin et on réutilise son résultat au lieu de lancer une seconde synchro.
+    """
+    verrou = verrou_synchronisation()
+    if verrou.acquire(blocking=False):
+        try:
+            get_activities_cached.clear()
+            return get_activities_cached()
+        finally:
+            verrou.release()
+    with verrou:
+        return get_activities_cached()
 df_activities = st.session_state.get("df_activities", None)
 with st.sidebar:
     st.subheader("🧠 Coach IA : pose une question")
@@ -352,8 +870,7 @@ if page == "🏠 Tableau général":
 
     if st.button("📥 Actualiser mes données Strava"):
         try:
-            get_activities_cached.clear()
-            df_activities = get_activities_cached()
+            df_activities = synchroniser_activites()
             st.session_state["df_activities"] = df_activities
             st.success("Données mises à jour.")
         except Exception as e:
@@ -374,7 +891,10 @@ else:
 df_cache = charger_cache_parquet()
 if 'id' not in df_cache.columns:
     st.warning("❗ Le cache Strava ne contient pas la colonne 'id'. Impossible d'afficher les courbes de fréquence cardiaque.")
-    df_cache = pd.DataFrame(columns=['id', 'FC Stream', 'Temps Stream', 'Distance Stream', 'Vitesse Stream'])
+    df_cache = pd.DataFrame(columns=[
+        'id', 'FC Stream', 'Temps Stream', 'Distance Stream', 'Vitesse Stream',
+        'Altitude Stream', 'LatLng Stream', 'Vitesse GAP Stream',
+    ])
 # Check if 'id' column exists
 if 'id' not in df.columns:
     st.warning("❗ Les données Strava ne contiennent pas la colonne 'id'.")
@@ -395,6 +915,9 @@ if page == "🏠 Tableau général":
     if "Allure (min/km)" in df_display.columns:
         df_display["Allure (mm:ss/km)"] = df_display["Allure (min/km)"].apply(minutes_to_mmss)
         df_display.drop(columns=["Allure (min/km)"], inplace=True)
+    if "Allure GAP (min/km)" in df_display.columns:
+        df_display["Allure GAP (mm:ss/km)"] = df_display["Allure GAP (min/km)"].apply(minutes_to_mmss)
+        df_display.drop(columns=["Allure GAP (min/km)"], inplace=True)
     st.dataframe(df_display)
 
     st.subheader("📊 Visualiser la fréquence cardiaque")
@@ -441,79 +964,88 @@ if page == "🏠 Tableau général":
             and len(fc_stream) > 0
             and len(fc_stream) == len(distance_stream)
         ):
-            df_graph = pd.DataFrame({
-                "Distance (km)": [d / 1000 for d in distance_stream],
-                "Fréquence cardiaque (bpm)": fc_stream
-            })
-
-            chart = alt.Chart(df_graph).mark_line(color="crimson").encode(
-                x=alt.X("Distance (km)", title="Distance (km)", scale=alt.Scale(zero=False)),
-                y=alt.Y("Fréquence cardiaque (bpm)", title="FC (bpm)", scale=alt.Scale(zero=False)),
-                tooltip=["Distance (km)", "Fréquence cardiaque (bpm)"]
-            ).interactive().properties(
-                width=700,
-                height=300,
-                title="Évolution de la FC pendant l'activité"
+            spec = spec_graphique(
+                selected_row.iloc[0]["id"],
+                "fc",
+                version_donnees_cache(),
+                lambda: graphique_fc(distance_stream, fc_stream, "Évolution de la FC pendant l'activité"),
             )
-
-            st.altair_chart(chart)
+            st.vega_lite_chart(spec)
         else:
             st.info("Pas de données de fréquence cardiaque disponibles pour cette activité.")
     else:
         st.warning("Sélection invalide.")
 
     st.subheader("📈 Volume hebdomadaire & Allure moyenne")
-    df_weekly = df.groupby("Semaine").agg({
-        "Distance (km)": "sum",
-        "Durée (min)": "sum"
-    }).reset_index()
-    df_weekly["Allure (min/km)"] = df_weekly["Durée (min)"] / df_weekly["Distance (km)"]
-    df_weekly["Allure (s/km)"] = df_weekly["Allure (min/km)"] * 60
-    df_weekly["Allure (mm:ss/km)"] = df_weekly["Allure (min/km)"].apply(minutes_to_mmss)
-
-    bar_chart = (
-        alt.Chart(df_weekly)
-        .mark_bar(color="#1f77b4")
-        .encode(
-            x=alt.X("Semaine:O", title="Semaine"),
-            y=alt.Y("Distance (km):Q", title="Distance (km)"),
-            tooltip=[
-                alt.Tooltip("Semaine:N", title="Semaine"),
-                alt.Tooltip("Distance (km):Q", title="Distance (km)"),
-                alt.Tooltip(field="Allure (mm:ss/km)", type="nominal", title="Allure (mm:ss/km)"),
-            ],
-        )
+    allure_gap_hebdo = st.toggle("Allure ajustée à la pente (GAP)", key="weekly_gap")
+    spec = spec_graphique(
+        type_choisi,
+        "hebdo_gap" if allure_gap_hebdo else "hebdo",
+        # Le cache est partagé entre sessions dont `df` peut différer du Parquet
+        empreinte_activites(df),
+        lambda: graphique_hebdo(df, allure_gap_hebdo),
     )
+    st.vega_lite_chart(spec)
 
-    line_chart = (
-        alt.Chart(df_weekly)
-        .mark_line(color="orange", point=True)
-        .encode(
-            x="Semaine:O",
-            y=alt.Y(
-                "Allure (s/km)",
-                type="quantitative",
-                title="Allure (mm:ss/km)",
-                axis=alt.Axis(
-                    titleColor="orange",
-                    labelExpr="timeFormat(datum.value*1000, '%M:%S')",
+    st.subheader("🏆 Meilleurs efforts (10 s à 2 h)")
+    # L'enveloppe est mise à jour à l'ingestion ; l'historique du cache n'est intégré
+    # qu'une fois, quand aucune enveloppe n'existe pour la grille de durées actuelle
+    if not enveloppe_mmp_initialisee() and not df_cache.empty:
+        enveloppe = mettre_a_jour_enveloppe_mmp(df_cache)
+        try:
+            enveloppe = commit_enveloppe_mmp(enveloppe)
+        except Exception as e:
+            st.warning("⚠️ Meilleurs efforts non synchronisés avec GitHub.")
+            st.exception(e)
+    else:
+        enveloppe = charger_enveloppe_mmp()
+    df_mmp = pd.DataFrame({
+        "Durée (s)": enveloppe["durees"],
+        "Vitesse (m/s)": pd.to_numeric(pd.Series(enveloppe["vitesse"]), errors="coerce"),
+        "FC soutenue (bpm)": pd.to_numeric(pd.Series(enveloppe["fc"]), errors="coerce").round(),
+    })
+    df_mmp["Durée"] = df_mmp["Durée (s)"].apply(seconds_to_hmmss)
+    df_mmp["Allure (s/km)"] = 1000 / df_mmp["Vitesse (m/s)"]
+    df_mmp["Allure (mm:ss/km)"] = pace_seconds_to_mmss(df_mmp["Allure (s/km)"])
+
+    if df_mmp["Vitesse (m/s)"].notna().any():
+        mmp_pace_chart = (
+            alt.Chart(df_mmp.dropna(subset=["Allure (s/km)"]))
+            .mark_line(color="steelblue", point=True)
+            .encode(
+                x=alt.X("Durée (s):Q", title="Durée (s)", scale=alt.Scale(type="log")),
+                y=alt.Y(
+                    "Allure (s/km)",
+                    type="quantitative",
+                    title="Meilleure allure (mm:ss/km)",
+                    scale=alt.Scale(zero=False, reverse=True),
+                    axis=alt.Axis(labelExpr="timeFormat(datum.value*1000, '%M:%S')"),
                 ),
-                scale=alt.Scale(reverse=True),
-            ),
-            tooltip=[
-                alt.Tooltip(
-                    field="Allure (mm:ss/km)",
-                    type="nominal",
-                    title="Allure (mm:ss/km)",
-                )
-            ],
+                tooltip=[
+                    alt.Tooltip(field="Durée", type="nominal", title="Durée"),
+                    alt.Tooltip(field="Allure (mm:ss/km)", type="nominal", title="Allure (mm:ss/km)"),
+                ],
+            )
+            .properties(width=700, height=300, title="Meilleure allure moyenne par durée")
         )
-    )
+        st.altair_chart(mmp_pace_chart)
 
-    chart = alt.layer(bar_chart, line_chart).resolve_scale(y='independent').properties(
-        width=700, height=400
-    )
-    st.altair_chart(chart)
+        mmp_hr_chart = (
+            alt.Chart(df_mmp.dropna(subset=["FC soutenue (bpm)"]))
+            .mark_line(color="crimson", point=True)
+            .encode(
+                x=alt.X("Durée (s):Q", title="Durée (s)", scale=alt.Scale(type="log")),
+                y=alt.Y("FC soutenue (bpm)", title="FC (bpm)", scale=alt.Scale(zero=False)),
+                tooltip=[
+                    alt.Tooltip(field="Durée", type="nominal", title="Durée"),
+                    alt.Tooltip("FC soutenue (bpm):Q", title="FC (bpm)"),
+                ],
+            )
+            .properties(width=700, height=300, title="FC moyenne maximale par durée")
+        )
+        st.altair_chart(mmp_hr_chart)
+    else:
+        st.info("Pas encore de streams de course pour calculer les meilleurs efforts.")
 
     st.subheader("📅 Prochaines séances du plan")
     if not df_plan.empty:
@@ -569,17 +1101,23 @@ if page == "🏠 Tableau général":
         if "last_json_modif" in st.session_state and st.button("✅ Appliquer cette modification au fichier"):
             try:
                 new_obj = json.loads(st.session_state["last_json_modif"])
-                df_plan["date"] = pd.to_datetime(df_plan["date"])
-                df_plan.set_index("date", inplace=True)
-                new_date = pd.to_datetime(new_obj["date"])
-                df_plan.loc[new_date] = new_obj
-                df_plan.reset_index(inplace=True)
-                df_plan.sort_values(by="date", inplace=True)
-
-                final_text = json.dumps(df_plan.to_dict(orient="records"), indent=2, ensure_ascii=False, default=str)
-                with open(PLAN_PATH, "w", encoding="utf-8") as f:
-                    f.write(final_text)
-                commit_to_github(final_text)
+                # Relecture sous verrou : df_plan a pu être modifié par une autre session depuis le chargement
+                with verrou_fichier(PLAN_PATH):
+                    if os.path.exists(PLAN_PATH):
+                        with open(PLAN_PATH, "r", encoding="utf-8") as f:
+                            plan_local = plan_vers_dataframe(json.load(f))
+                    else:
+                        plan_local = df_plan
+                    final_text = appliquer_modification_plan(plan_local, new_obj)
+                    ecrire_fichier_atomique(PLAN_PATH, final_text.encode("utf-8"))
+
+                def fusionner_plan_distant(texte_distant):
+                    return appliquer_modification_plan(plan_vers_dataframe(json.loads(texte_distant)), new_obj)
+
+                texte_commite = commit_to_github(final_text, fusionner=fusionner_plan_distant)
+                # Le plan distant a pu intégrer les modifications d'autres sessions
+                with verrou_fichier(PLAN_PATH):
+                    ecrire_fichier_atomique(PLAN_PATH, texte_commite.encode("utf-8"))
                 st.success("✅ Plan mis à jour et synchronisé avec GitHub.")
                 st.rerun()
             except Exception as e:
@@ -640,9 +1178,15 @@ elif page == "💥 Analyse Fractionné":
                 # --- Streams depuis le cache
                 cached = df_cache[df_cache["id"] == act_id]
                 if not cached.empty:
-                    distance_stream = [d / 1000 for d in cached.iloc[0]["Distance Stream"]]
+                    distance_stream = cached.iloc[0]["Distance Stream"]
                     fc_stream = cached.iloc[0]["FC Stream"]
                     velocity_stream = cached.iloc[0].get("Vitesse Stream", [])
+                    gap_stream = cached.iloc[0].get("Vitesse GAP Stream", None)
+                    gap_disponible = gap_stream is not None and not isinstance(gap_stream, float) and len(gap_stream) > 0
+                    # La clé du toggle est partagée entre activités : il peut rester actif sans GAP disponible
+                    allure_gap = gap_disponible and st.toggle("Allure ajustée à la pente (GAP)", key="frac_gap", disabled=not gap_disponible)
+                    if allure_gap:
+                        velocity_stream = gap_stream
 
                     if (
                         fc_stream is not None
@@ -651,22 +1195,13 @@ elif page == "💥 Analyse Fractionné":
                         and len(distance_stream) > 0
                         and len(distance_stream) == len(fc_stream)
                     ):
-                        df_hr = pd.DataFrame({
-                            "Distance (km)": distance_stream,
-                            "Fréquence cardiaque (bpm)": fc_stream,
-                        })
-                        hr_chart = (
-                            alt.Chart(df_hr)
-                            .mark_line(color="crimson")
-                            .encode(
-                                x=alt.X("Distance (km)", title="Distance (km)", scale=alt.Scale(zero=False)),
-                                y=alt.Y("Fréquence cardiaque (bpm)", title="FC (bpm)", scale=alt.Scale(zero=False)),
-                                tooltip=["Distance (km)", "Fréquence cardiaque (bpm)"]
-                            )
-                            .interactive()
-                            .properties(width=700, height=300, title="Évolution de la FC")
+                        spec = spec_graphique(
+                            act_id,
+                            "fc_fractionne",
+                            version_donnees_cache(),
+                            lambda: graphique_fc(distance_stream, fc_stream, "Évolution de la FC"),
                         )
-                        st.altair_chart(hr_chart)
+                        st.vega_lite_chart(spec)
                     else:
                         st.info("Pas de données de fréquence cardiaque.")
 
@@ -677,34 +1212,13 @@ elif page == "💥 Analyse Fractionné":
                         and len(distance_stream) > 0
                         and len(distance_stream) == len(velocity_stream)
                     ):
-                        pace_stream = [16.6667 / v if v else None for v in velocity_stream]
-                        pace_seconds = [p * 60 if p is not None else None for p in pace_stream]
-                        df_pace = pd.DataFrame({
-                            "Distance (km)": distance_stream,
-                            "Allure (s/km)": pace_seconds,
-                            "Allure (mm:ss/km)": [minutes_to_mmss(p) if p is not None else "" for p in pace_stream],
-                        })
-                        pace_chart = (
-                            alt.Chart(df_pace)
-                            .mark_line(color="steelblue")
-                            .encode(
-                                x=alt.X("Distance (km)", title="Distance (km)", scale=alt.Scale(zero=False)),
-                                y=alt.Y(
-                                    "Allure (s/km)",
-                                    type="quantitative",
-                                    title="Allure (mm:ss/km)",
-                                    scale=alt.Scale(zero=False, reverse=True),
-                                    axis=alt.Axis(labelExpr="timeFormat(datum.value*1000, '%M:%S')"),
-                                ),
-                                tooltip=[
-                                    alt.Tooltip("Distance (km):Q", title="Distance (km)"),
-                                    alt.Tooltip(field="Allure (mm:ss/km)", type="nominal", title="Allure (mm:ss/km)"),
-                                ]
-                            )
-                            .interactive()
-                            .properties(width=700, height=300, title="Évolution de l'allure")
+                        spec = spec_graphique(
+                            act_id,
+                            "allure_gap" if allure_gap else "allure",
+                            version_donnees_cache(),
+                            lambda: graphique_allure(distance_stream, velocity_stream),
                         )
-                        st.altair_chart(pace_chart)
+                        st.vega_lite_chart(spec)
                     else:
                         missing_fields = []
                         if distance_stream is None or len(distance_stream) == 0: